@@ -2,12 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import os
+import datetime
+import re
 import time
+import queue
+import signal
+import threading
 import fnmatch
 import argparse
-from collections import Counter
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Iterable, List, Set, Tuple
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 from email.parser import BytesParser
 from email.policy import default as email_policy
 from email.utils import getaddresses
@@ -15,12 +24,31 @@ from email.utils import getaddresses
 from dotenv import load_dotenv
 from imapclient import IMAPClient
 
+try:
+    import hyperscan  # optional: multi-pattern matching for large mask rule sets
+except ImportError:
+    hyperscan = None
+
 # Всегда подхватываем .env рядом со скриптом
 load_dotenv(dotenv_path=Path(__file__).with_name(".env"), override=True)
 
 IMAP_HOST = "imap.rambler.ru"
 IMAP_PORT = 993
 
+# RFC 2177: клиент должен перезапускать IDLE не реже чем раз в 29 минут
+IDLE_REFRESH = 25 * 60
+# Остальные сессии держим живыми NOOP'ом (autologout по RFC 3501 — не меньше 30 минут)
+KEEPALIVE_INTERVAL = 5 * 60
+
+# С UIDPLUS удаляем крупными пачками: UID EXPUNGE затрагивает только переданные UID
+UIDPLUS_DELETE_BATCH = 5000
+
+# Больше доменных правил — предфильтр по суффиксам хоста через set вместо str.endswith(tuple)
+ENDSWITH_MAX_DOMAINS = 512
+
+# С установленным hyperscan маски компилируются в одну его базу, если их хотя бы столько
+HYPERSCAN_MIN_MASKS = 32
+
 # Правила по умолчанию:
 # - обычный домен (ozon.ru) матчится как ozon.ru и *.ozon.ru (поддомены тоже)
 # - маска с '@' матчится по полному адресу отправителя (для Apple private relay)
@@ -68,7 +96,15 @@ def _to_str(x) -> str:
     return x.decode() if isinstance(x, (bytes, bytearray)) else str(x)
 
 
-def chunked(seq: List[int], size: int) -> Iterable[List[int]]:
+def uid_array(uids: Iterable[int]) -> "array[int]":
+    """
+    UIDs are 32-bit unsigned (RFC 3501): 4 bytes each in an array instead of
+    a ~28-byte int object per UID in a list.
+    """
+    return array("I", uids)
+
+
+def chunked(seq: Sequence[int], size: int) -> Iterable[Sequence[int]]:
     for i in range(0, len(seq), size):
         yield seq[i:i + size]
 
@@ -103,12 +139,41 @@ def with_retries(fn, attempts: int = 4, base_delay: float = 2.0):
     raise last  # pragma: no cover
 
 
+def iter_fetched(servers: List[IMAPClient], parts: Iterable[Sequence[int]],
+                 fetch: Callable[[IMAPClient, Sequence[int]], dict]) -> Iterable[dict]:
+    """
+    Yields fetch(server, part) results in the order of parts, keeping one
+    request in flight per connection, so the next batches are already on
+    the wire while the caller processes the current one.
+    """
+    it = iter(parts)
+    with ThreadPoolExecutor(max_workers=len(servers)) as pool:
+        pending = deque()
+        for srv in servers:
+            part = next(it, None)
+            if part is None:
+                break
+            pending.append((srv, pool.submit(fetch, srv, part)))
+        while pending:
+            srv, fut = pending.popleft()
+            result = fut.result()
+            part = next(it, None)
+            if part is not None:
+                pending.append((srv, pool.submit(fetch, srv, part)))
+            yield result
+
+
 def is_noselect(flags) -> bool:
     normalized = {_to_str(f) for f in (flags or [])}
     return "\\Noselect" in normalized or "\\NOSELECT" in normalized
 
 
-def list_selectable_mailboxes(server: IMAPClient) -> List[str]:
+# Selectable folders per IMAP session (keyed by id(server)): daemon passes re-resolve
+# --folders against it instead of issuing LIST every pass
+_folder_cache: Dict[int, List[str]] = {}
+
+
+def _list_selectable(server: IMAPClient) -> List[str]:
     folders: List[str] = []
     for flags, _delim, name in server.list_folders():
         if is_noselect(flags):
@@ -117,18 +182,57 @@ def list_selectable_mailboxes(server: IMAPClient) -> List[str]:
     return folders
 
 
-def envelope_from_parts(envelope) -> Tuple[str, str, str]:
+def list_selectable_mailboxes(server: IMAPClient, refresh: bool = False) -> List[str]:
+    key = id(server)
+    if refresh or key not in _folder_cache:
+        _folder_cache[key] = _list_selectable(server)
+    return _folder_cache[key]
+
+
+# From: header fetched instead of ENVELOPE: the server returns (and parses) much less
+FROM_HEADER_FETCH = "BODY.PEEK[HEADER.FIELDS (FROM)]"
+
+# From: field value including folded continuation lines
+_FROM_FIELD_RE = re.compile(rb"^From:[ \t]*((?:[^\r\n]|\r?\n[ \t])*)", re.M | re.I)
+_ANGLE_ADDR_RE = re.compile(rb"<\s*([A-Za-z0-9._%+\-]+)@([A-Za-z0-9.\-]+)\s*>")
+_BARE_ADDR_RE = re.compile(rb"\s*([A-Za-z0-9._%+\-]+)@([A-Za-z0-9.\-]+)\s*")
+
+
+def fetch_from_headers(server: IMAPClient, uids: Sequence[int], attempts: int, base_delay: float) -> dict:
+    return with_retries(lambda: server.fetch(uids, [FROM_HEADER_FETCH]),
+                        attempts=attempts, base_delay=base_delay)
+
+
+def from_header_bytes(item) -> bytes:
+    return (
+        item.get(b"BODY[HEADER.FIELDS (FROM)]")
+        or item.get(b"BODY.PEEK[HEADER.FIELDS (FROM)]")
+        or b""
+    )
+
+
+def _parse_from_fast(header_bytes: bytes) -> Optional[Tuple[str, str]]:
     """
-    Returns (mailbox, host, full_email) from ENVELOPE.From[0]
-    full_email is "mailbox@host" lowercased.
+    Regex-only parse of the usual "Name <user@host>" / "user@host" forms.
+    Returns None when the header needs the full email parser: quoted display
+    names and (comments) (both may contain "<...@...>" themselves), several
+    angle addresses, or a bare address that is not the whole value
+    (bounce=abc@host).
     """
-    if not envelope or not getattr(envelope, "from_", None):
-        return "", "", ""
-    a = envelope.from_[0]
-    mailbox = _to_str(getattr(a, "mailbox", "")) or ""
-    host = _to_str(getattr(a, "host", "")) or ""
-    full = f"{mailbox}@{host}".lower() if mailbox and host else ""
-    return mailbox.lower(), host.lower(), full
+    field = _FROM_FIELD_RE.search(header_bytes)
+    if not field:
+        return None
+    value = field.group(1)
+    if b'"' in value or b"(" in value or value.count(b"<") > 1:
+        return None
+    if b"<" in value:
+        m = _ANGLE_ADDR_RE.search(value)
+    else:
+        m = _BARE_ADDR_RE.fullmatch(value)
+    if not m:
+        return None
+    host = m.group(2).decode("ascii").lower()
+    return host, f"{m.group(1).decode('ascii').lower()}@{host}"
 
 
 def parse_from_header(header_bytes: bytes) -> Tuple[str, str]:
@@ -138,6 +242,9 @@ def parse_from_header(header_bytes: bytes) -> Tuple[str, str]:
     """
     if not header_bytes:
         return "", ""
+    fast = _parse_from_fast(header_bytes)
+    if fast is not None:
+        return fast
     msg = BytesParser(policy=email_policy).parsebytes(header_bytes)
     from_value = msg.get("From", "")
     if not from_value:
@@ -161,32 +268,399 @@ def rule_kind(rule: str) -> str:
     return "domain"
 
 
-def match_rule(rule: str, host: str, full_email: str) -> bool:
-    r = rule.strip().lower()
-    kind = rule_kind(r)
+def normalize_rules(raw_rules: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    Returns [(kind, rule)] with every rule stripped and lowercased once,
+    so nothing rule-related is recomputed per message.
+    Empty entries and duplicates are dropped, as are domain rules already
+    covered by a broader one (news.ozon.ru when ozon.ru is listed).
+    """
+    seen: Set[str] = set()
+    compiled: List[Tuple[str, str]] = []
+    for raw in raw_rules:
+        r = raw.strip().lower()
+        if not r or r in seen:
+            continue
+        seen.add(r)
+        compiled.append((rule_kind(r), r))
+
+    domains = {r for kind, r in compiled if kind == "domain"}
+    result: List[Tuple[str, str]] = []
+    for kind, r in compiled:
+        if kind == "domain":
+            labels = r.split(".")
+            covering = next((".".join(labels[i:]) for i in range(len(labels) - 1, 0, -1)
+                             if ".".join(labels[i:]) in domains), None)
+            if covering:
+                print(f"[SKIP] Rule '{r}' is covered by '{covering}'")
+                continue
+        result.append((kind, r))
+    return result
 
-    if kind == "email_mask":
-        return bool(full_email) and fnmatch.fnmatch(full_email, r)
 
-    if kind == "host_mask":
-        return bool(host) and fnmatch.fnmatch(host.lower(), r)
+def mask_to_regex(rule: str) -> str:
+    """
+    Translate a normalized mask rule into a regex body without the trailing
+    end anchor, so several masks can be joined into one alternation.
+    """
+    # fnmatchcase semantics: no os.path.normcase, rule and input are already lowercase
+    pattern = fnmatch.translate(rule)
+    return pattern[:-2] if pattern.endswith(("\\Z", "\\z")) else pattern
 
-    # domain: host == dom OR host endswith ".dom"
-    if not host:
-        return False
-    h = host.lower()
-    return h == r or h.endswith("." + r)
+
+# Ключ конца правила в узле trie: не строка, поэтому не совпадёт ни с какой меткой хоста
+_RULE_END = object()
+
+
+def build_domain_trie(compiled_rules: List[Tuple[str, str]]) -> dict:
+    """
+    Nested dicts keyed by host labels from the TLD down ("ru" -> "ozon");
+    a node holding _RULE_END ends a domain rule and stores its index.
+    """
+    trie: dict = {}
+    for i, (kind, r) in enumerate(compiled_rules):
+        if kind != "domain":
+            continue
+        node = trie
+        for label in reversed(r.split(".")):
+            node = node.setdefault(label, {})
+        node.setdefault(_RULE_END, i)
+    return trie
+
+
+def trie_lookup(trie: dict, host: str) -> List[int]:
+    """
+    Indices of all domain rules covering host: host == dom OR host endswith ".dom".
+    One walk over the host labels, whatever the number of rules.
+    """
+    hits: List[int] = []
+    node = trie
+    for label in reversed(host.split(".")):
+        node = node.get(label)
+        if node is None:
+            break
+        if _RULE_END in node:
+            hits.append(node[_RULE_END])
+    return hits
+
+
+def host_suffixes(host: str) -> Iterator[str]:
+    """
+    "a.b.ru" -> "a.b.ru", "b.ru", "ru".
+    """
+    i = 0
+    while True:
+        yield host[i:]
+        i = host.find(".", i) + 1
+        if i == 0:
+            return
+
+
+def domain_scanner(compiled_rules: List[Tuple[str, str]]) -> Optional[Callable[[str], List[int]]]:
+    """
+    host -> indices of covering domain rules. A cheap prefilter rejects most
+    hosts; only hits walk the trie to find out which rules matched.
+    For a normal rule list the prefilter is str.endswith() with a tuple of
+    ".dom" suffixes (one C-level call). endswith() still tries every suffix,
+    so for big lists the host's label suffixes are probed in a set instead:
+    one hash lookup per label, whatever the number of rules.
+    """
+    trie = build_domain_trie(compiled_rules)
+    if not trie:
+        return None
+    exact = frozenset(r for kind, r in compiled_rules if kind == "domain")
+
+    if len(exact) <= ENDSWITH_MAX_DOMAINS:
+        suffixes = tuple("." + r for r in exact)
+
+        def covered(host: str) -> bool:
+            return host in exact or host.endswith(suffixes)
+    else:
+        def covered(host: str) -> bool:
+            return any(s in exact for s in host_suffixes(host))
+
+    def scan(host: str) -> List[int]:
+        if covered(host):
+            return trie_lookup(trie, host)
+        return []
+
+    return scan
+
+
+def union_scanner(masks: List[Tuple[int, str]]) -> Optional[Callable[[str], List[int]]]:
+    """
+    Regex path for (index, mask) pairs; every matching rule is reported, like
+    the domain trie and the Hyperscan path. The union of all masks (one named
+    group r<index> per rule) rejects non-matching values in one probe. On a
+    hit, Match.lastgroup is the first matching rule (earlier alternatives
+    could not match), so only the masks after it are tried one by one.
+    """
+    if not masks:
+        return None
+    bodies = [(i, mask_to_regex(r)) for i, r in masks]
+    union = re.compile("(?:" + "|".join(f"(?P<r{i}>{body})" for i, body in bodies) + r")\Z")
+    singles = [(i, re.compile(body + r"\Z")) for i, body in bodies]
+    position = {i: pos for pos, (i, _body) in enumerate(bodies)}
+
+    def scan(value: str) -> List[int]:
+        m = union.match(value)
+        if not m:
+            return []
+        first = int(m.lastgroup[1:])
+        return [first] + [i for i, rx in singles[position[first] + 1:] if rx.match(value)]
+
+    return scan
+
+
+def compile_rules(compiled_rules: List[Tuple[str, str]]) -> Tuple[
+        Optional[Callable[[str], List[int]]], Optional[Callable[[str], List[int]]]]:
+    """
+    Pure-Python (host_scan, email_scan) for mask rules: host masks are matched
+    against host, email masks against full_email. Domain rules are left to the trie.
+    """
+    return (
+        union_scanner([(i, r) for i, (kind, r) in enumerate(compiled_rules) if kind == "host_mask"]),
+        union_scanner([(i, r) for i, (kind, r) in enumerate(compiled_rules) if kind == "email_mask"]),
+    )
+
+
+def _glob_bracket_end(rule: str, i: int) -> int:
+    """
+    Index of the "]" closing the fnmatch bracket opened just before rule[i],
+    or -1 if it is unclosed (then "[" is a literal). As in fnmatch, a "]"
+    right after "[" or "[!" belongs to the set.
+    """
+    j, n = i, len(rule)
+    if j < n and rule[j] == "!":
+        j += 1
+    if j < n and rule[j] == "]":
+        j += 1
+    while j < n and rule[j] != "]":
+        j += 1
+    return j if j < n else -1
+
+
+def _glob_class(rule: str, i: int, j: int) -> str:
+    """
+    Body of the fnmatch bracket rule[i:j] as regex class text, mirroring
+    fnmatch.translate(): hyphen chunks, out-of-order ranges removed.
+    Returns "" for an empty range and "!" for a negated empty one.
+    """
+    if "-" not in rule[i:j]:
+        stuff = rule[i:j].replace("\\", "\\\\")
+    else:
+        chunks = []
+        k = i + 2 if rule[i] == "!" else i + 1
+        while True:
+            k = rule.find("-", k, j)
+            if k < 0:
+                break
+            chunks.append(rule[i:k])
+            i = k + 1
+            k = k + 3
+        chunk = rule[i:j]
+        if chunk:
+            chunks.append(chunk)
+        else:
+            chunks[-1] += "-"
+        # Remove empty ranges (z-a): invalid in a regex
+        for k in range(len(chunks) - 1, 0, -1):
+            if chunks[k - 1][-1] > chunks[k][0]:
+                chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+                del chunks[k]
+        stuff = "-".join(c.replace("\\", "\\\\").replace("-", "\\-") for c in chunks)
+    # Brackets are always escaped: PCRE would read "[:" as a POSIX class
+    head, body = (stuff[:1], stuff[1:]) if stuff.startswith("!") else ("", stuff)
+    body = body.replace("[", "\\[").replace("]", "\\]")
+    if not head and body.startswith("^"):
+        body = "\\" + body
+    return head + body
+
+
+def mask_to_hyperscan(rule: str) -> Optional[bytes]:
+    """
+    Anchored Hyperscan expression for a mask, or None if the mask can never
+    match (empty bracket range). fnmatch.translate() output is not reused: it
+    may contain atomic groups and (?!), which Hyperscan does not support.
+    """
+    out = ["^"]
+    i, n = 0, len(rule)
+    while i < n:
+        ch = rule[i]
+        i += 1
+        if ch == "*":
+            out.append(".*")
+        elif ch == "?":
+            out.append(".")
+        elif ch == "[":
+            j = _glob_bracket_end(rule, i)
+            if j < 0:
+                out.append("\\[")
+                continue
+            stuff = _glob_class(rule, i, j)
+            i = j + 1
+            if not stuff:
+                return None
+            if stuff == "!":
+                out.append(".")
+            elif stuff[0] == "!":
+                out.append(f"[^{stuff[1:]}]")
+            else:
+                out.append(f"[{stuff}]")
+        else:
+            out.append(re.escape(ch))
+    out.append(r"\z")
+    return "".join(out).encode("utf-8")
+
+
+def hyperscan_scanner(masks: List[Tuple[int, str]]) -> Optional[Callable[[str], List[int]]]:
+    """
+    Compiles (index, mask) pairs into one Hyperscan database; every matching
+    rule is reported, same as union_scanner(). Scratch space is per thread,
+    because folders may be scanned in parallel.
+    Raises hyperscan.error if a mask does not compile.
+    """
+    expressions = [(i, expr) for i, expr in ((i, mask_to_hyperscan(r)) for i, r in masks) if expr is not None]
+    if not expressions:
+        return None
+    db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+    db.compile(
+        expressions=[expr for _i, expr in expressions],
+        ids=[i for i, _expr in expressions],
+        elements=len(expressions),
+        # UTF8: "?" and classes match one character, not one byte, as in fnmatch
+        flags=hyperscan.HS_FLAG_DOTALL | hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_UTF8,
+    )
+    local = threading.local()
+
+    def scan(value: str) -> List[int]:
+        scratch = getattr(local, "scratch", None)
+        if scratch is None:
+            scratch = local.scratch = hyperscan.Scratch(db)
+        hits: List[int] = []
+        db.scan(value.encode("utf-8"), match_event_handler=lambda rule_id, *_: hits.append(rule_id),
+                scratch=scratch)
+        return sorted(hits)
+
+    return scan
+
+
+def compile_mask_scanners(compiled_rules: List[Tuple[str, str]]) -> Tuple[
+        Optional[Callable[[str], List[int]]], Optional[Callable[[str], List[int]]]]:
+    """
+    Returns (host_scan, email_scan): value -> indices of every matching rule.
+    Hyperscan is used when installed and the mask rule set is large enough
+    to pay off; otherwise the pure-Python regex unions. Both report the same
+    rules, so per-rule counts do not depend on the backend.
+    """
+    masks = [(i, kind, r) for i, (kind, r) in enumerate(compiled_rules) if kind != "domain"]
+    if hyperscan is not None and len(masks) >= HYPERSCAN_MIN_MASKS:
+        try:
+            return (
+                hyperscan_scanner([(i, r) for i, kind, r in masks if kind == "host_mask"]),
+                hyperscan_scanner([(i, r) for i, kind, r in masks if kind == "email_mask"]),
+            )
+        except hyperscan.error as e:
+            print(f"[WARN] Hyperscan cannot compile the masks, using Python regex: {e}")
+    return compile_rules(compiled_rules)
+
+
+def match_rules(domain_scan: Optional[Callable[[str], List[int]]],
+                host_scan: Optional[Callable[[str], List[int]]],
+                email_scan: Optional[Callable[[str], List[int]]],
+                host: str, full_email: str) -> List[int]:
+    """
+    Returns indices of all matched rules: every covering domain rule and
+    every matching mask rule.
+    """
+    hits: List[int] = []
+    if domain_scan is not None and host:
+        hits.extend(domain_scan(host))
+    if host_scan is not None and host:
+        hits.extend(host_scan(host))
+    if email_scan is not None and full_email:
+        hits.extend(email_scan(full_email))
+    return hits
 
 
-def delete_uids(server: IMAPClient, uids: List[int], batch: int, uidplus: bool) -> int:
+def literal_runs(rule: str) -> List[str]:
+    """
+    Wildcard-free pieces of a mask, with brackets tokenized as fnmatch does:
+    "[]ab]x*" -> ["", "x", ""]; a plain domain is a single run.
+    """
+    runs = [""]
+    i, n = 0, len(rule)
+    while i < n:
+        ch = rule[i]
+        i += 1
+        if ch in "*?":
+            runs.append("")
+        elif ch == "[" and _glob_bracket_end(rule, i) >= 0:
+            i = _glob_bracket_end(rule, i) + 1
+            runs.append("")
+        else:
+            runs[-1] += ch
+    return runs
+
+
+def search_needles(rules: List[str], min_len: int = 3) -> Optional[List[str]]:
+    """
+    Literal substrings for server-side SEARCH FROM, one per rule: the domain
+    itself or the longest wildcard-free run of a mask. Returns None if some
+    rule has no usable literal, since then every message has to be fetched.
+    """
+    needles: List[str] = []
+    for r in rules:
+        longest = max(literal_runs(r), key=len)
+        if len(longest) < min_len:
+            return None
+        if longest not in needles:
+            needles.append(longest)
+    return needles
+
+
+def make_matcher(compiled_rules: List[Tuple[str, str]],
+                 cache_size: int = 4096) -> Callable[[str, str], Tuple[int, ...]]:
+    """
+    Returns match(host, full_email) -> tuple of matched rule indices.
+    Senders repeat a lot within a mailbox, so results are memoized.
+    """
+    domain_scan = domain_scanner(compiled_rules)
+    host_scan, email_scan = compile_mask_scanners(compiled_rules)
+
+    @lru_cache(maxsize=cache_size)
+    def match(host: str, full_email: str) -> Tuple[int, ...]:
+        return tuple(match_rules(domain_scan, host_scan, email_scan, host=host, full_email=full_email))
+
+    return match
+
+
+def uid_ranges(uids: Sequence[int]) -> str:
+    """
+    Sorted UIDs -> IMAP sequence set with contiguous runs collapsed:
+    [1, 2, 3, 7] -> "1:3,7".
+    """
+    out: List[str] = []
+    i, n = 0, len(uids)
+    while i < n:
+        j = i
+        while j + 1 < n and uids[j + 1] == uids[j] + 1:
+            j += 1
+        out.append(str(uids[i]) if i == j else f"{uids[i]}:{uids[j]}")
+        i = j + 1
+    return ",".join(out)
+
+
+def delete_uids(server: IMAPClient, uids: Sequence[int], batch: int, uidplus: bool) -> int:
     if not uids:
         return 0
 
     deleted = 0
     for part in chunked(uids, max(1, batch)):
-        server.delete_messages(part)
+        seq = uid_ranges(part)
+        server.delete_messages(seq)
         if uidplus and hasattr(server, "uid_expunge"):
-            server.uid_expunge(part)
+            server.uid_expunge(seq)
         else:
             server.expunge()
         deleted += len(part)
@@ -202,147 +676,362 @@ def parse_args() -> argparse.Namespace:
     ap.add_argument("--list-folders", action="store_true", help="List IMAP folders and exit")
     ap.add_argument("--rules", default=",".join(RULES_DEFAULT),
                     help="Comma-separated rules (domains/masks). Example: ozon.ru,*.mvideo.ru,*reddit*@privaterelay.appleid.com")
+    ap.add_argument("--since-days", type=int, default=None,
+                    help="Only messages received in the last N days (IMAP SEARCH SINCE)")
+    ap.add_argument("--server-search", action="store_true",
+                    help="Pre-select candidates with IMAP SEARCH FROM and fetch only them (faster, relies on server search)")
     ap.add_argument("--delete", action="store_true", help="Actually delete (otherwise dry-run)")
     ap.add_argument("--batch", type=int, default=500, help="Batch size for fetch/delete (default 500)")
+    ap.add_argument("--delete-batch", type=int, default=None,
+                    help=f"Batch size for delete (default {UIDPLUS_DELETE_BATCH} with UIDPLUS, otherwise --batch)")
+    ap.add_argument("--no-prefetch", action="store_true",
+                    help="Fetch over a single IMAP session (by default a second one prefetches batches)")
+    ap.add_argument("--workers", type=int, default=4,
+                    help="Parallel IMAP sessions when several folders are processed (default 4)")
+    ap.add_argument("--daemon", action="store_true",
+                    help="Keep the session open and repeat the cleanup (IDLE between passes, SIGUSR1 triggers a pass)")
+    ap.add_argument("--interval", type=float, default=3600.0,
+                    help="Daemon mode: seconds between passes (default 3600)")
     ap.add_argument("--retries", type=int, default=4, help="Retries on [INUSE]/indexing (default 4)")
     ap.add_argument("--retry-delay", type=float, default=2.0, help="Base retry delay seconds (default 2.0)")
-    return ap.parse_args()
+    args = ap.parse_args()
+    if args.since_days is not None and args.since_days < 1:
+        ap.error("--since-days must be at least 1")
+    return args
 
 
-def main() -> None:
-    args = parse_args()
+# Папки могут обрабатываться параллельно: отчёт по папке печатается целиком
+_print_lock = threading.Lock()
 
-    user = args.user or os.getenv("RAMBLER_USER")
-    password = args.password or os.getenv("RAMBLER_PASS")
-    if not user or not password:
-        raise SystemExit("Set credentials via --user/--password or env RAMBLER_USER / RAMBLER_PASS")
 
-    rules = [r.strip() for r in (args.rules or "").split(",") if r.strip()]
-    if not rules:
-        raise SystemExit("No rules provided")
+def emit(*lines: str) -> None:
+    with _print_lock:
+        print("\n".join(lines))
+
+
+def login_session(stack: ExitStack, user: str, password: str) -> IMAPClient:
+    server = stack.enter_context(IMAPClient(IMAP_HOST, port=IMAP_PORT, ssl=True))
+    server.login(user, password)
+    return server
+
+
+def is_connection_error(e: Exception) -> bool:
+    return isinstance(e, (IMAPClient.AbortError, OSError)) or is_inuse_error(e)
 
-    skip = {f.strip() for f in (args.skip_folders or "").split(",") if f.strip()}
 
-    with IMAPClient(IMAP_HOST, port=IMAP_PORT, ssl=True) as server:
+@contextmanager
+def open_sessions(user: str, password: str) -> Iterator[Tuple[IMAPClient, ExitStack]]:
+    """
+    Logs in the main session. Yields (server, extra): extra owns the
+    additional sessions opened by open_extra_sessions() and closes them
+    together with the main one.
+    """
+    with IMAPClient(IMAP_HOST, port=IMAP_PORT, ssl=True) as server, ExitStack() as extra:
         server.login(user, password)
+        try:
+            yield server, extra
+        finally:
+            _folder_cache.pop(id(server), None)
 
-        selectable = list_selectable_mailboxes(server)
-        if args.list_folders:
-            print("Selectable folders:")
-            for f in selectable:
-                print(" -", f)
-            return
 
-        if args.folders.strip() == "*" or not args.folders.strip():
-            folders = [f for f in selectable if f not in skip]
-        else:
-            want = [f.strip() for f in args.folders.split(",") if f.strip()]
-            folders = [f for f in selectable if f in want and f not in skip]
+def extra_sessions_needed(args: argparse.Namespace, folder_count: int) -> int:
+    """
+    Several folders: workers - 1 sessions scan folders next to the main one.
+    One folder: a single session prefetches headers (unless --no-prefetch).
+    """
+    workers = min(max(1, args.workers), folder_count)
+    if workers > 1:
+        return workers - 1
+    return 0 if args.no_prefetch or not folder_count else 1
+
+
+def open_extra_sessions(extra: ExitStack, user: str, password: str, count: int) -> List[IMAPClient]:
+    """
+    Extra sessions live as long as the main one (they are NOOPed between
+    daemon passes), so login is paid once, not per pass.
+    """
+    sessions: List[IMAPClient] = []
+    for _ in range(count):
+        try:
+            sessions.append(login_session(extra, user, password))
+        except Exception as e:
+            print(f"[WARN] Extra IMAP session unavailable, continuing with {len(sessions) + 1} connection(s): {e}")
+            break
+    return sessions
 
-        uidplus = supports_uidplus(server)
 
-        print(f"Server: {IMAP_HOST}:{IMAP_PORT} SSL | Folders: {len(folders)} | Mode: {'DELETE' if args.delete else 'DRY-RUN'}")
-        print("Rules:")
-        for r in rules:
-            print(f"  {r} ({rule_kind(r)})")
-        print()
+def resolve_folders(selectable: List[str], folders_arg: str, skip: Set[str]) -> List[str]:
+    if folders_arg.strip() == "*" or not folders_arg.strip():
+        return [f for f in selectable if f not in skip]
+    want = {f.strip() for f in folders_arg.split(",") if f.strip()}
+    for missing in sorted(want.difference(selectable)):
+        print(f"[WARN] Folder '{missing}' not found (see --list-folders)")
+    return [f for f in selectable if f in want and f not in skip]
 
-        grand_per_rule = Counter()
-        grand_unique = 0
-        grand_deleted = 0
 
-        for folder in folders:
-            try:
-                server.select_folder(folder, readonly=not args.delete)
-            except Exception as e:
-                print(f"[SKIP] Cannot select folder '{folder}': {e}")
+def search_criteria(since_days: Optional[int]) -> list:
+    """
+    Base SEARCH criteria: not deleted and, with --since-days, only recent
+    messages, so older mail is never fetched.
+    """
+    criteria: list = ["NOT", "DELETED"]
+    if since_days is not None:
+        criteria += ["SINCE", datetime.date.today() - datetime.timedelta(days=since_days)]
+    return criteria
+
+
+def search_candidates(server: IMAPClient, criteria: list, needles: List[str],
+                      attempts: int, base_delay: float) -> List[int]:
+    """
+    Union of SEARCH FROM hits for every needle. These are only candidates:
+    FROM is a substring match over the whole header, so each one is still
+    fetched and matched against the rules.
+    """
+    found: Set[int] = set()
+    for needle in needles:
+        # imapclient encodes criteria as us-ascii unless a charset is given
+        charset = None if needle.isascii() else "UTF-8"
+        found.update(with_retries(lambda: server.search(criteria + ["FROM", needle], charset=charset),
+                                  attempts=attempts, base_delay=base_delay))
+    return sorted(found)
+
+
+def scan_folder(server: IMAPClient, prefetch_servers: List[IMAPClient], folder: str,
+                match: Callable[[str, str], Tuple[int, ...]], rules: List[str],
+                args: argparse.Namespace, uidplus: bool) -> Tuple[List[int], int, int]:
+    """
+    Scans one folder and deletes matches when --delete is set.
+    Returns (per_rule, unique_matched, deleted); per_rule is indexed like rules.
+    """
+    try:
+        server.select_folder(folder, readonly=not args.delete)
+    except Exception as e:
+        if is_connection_error(e):
+            raise
+        emit(f"[SKIP] Cannot select folder '{folder}': {e}")
+        return [0] * len(rules), 0, 0
+
+    criteria = search_criteria(args.since_days)
+    needles = search_needles(rules) if args.server_search else None
+    try:
+        if needles is not None:
+            all_uids = uid_array(search_candidates(server, criteria, needles, attempts=args.retries,
+                                                   base_delay=args.retry_delay))
+        else:
+            all_uids = uid_array(with_retries(lambda: server.search(criteria),
+                                              attempts=args.retries, base_delay=args.retry_delay))
+    except Exception as e:
+        emit(f"[WARN] UID listing failed in '{folder}': {e}")
+        return [0] * len(rules), 0, 0
+
+    fetch_servers = [server]
+    for srv in prefetch_servers:
+        try:
+            srv.select_folder(folder, readonly=True)
+            fetch_servers.append(srv)
+        except Exception as e:
+            if is_connection_error(e):
+                raise
+            emit(f"[WARN] Prefetch session cannot select '{folder}': {e}")
+
+    per_rule = [0] * len(rules)
+    matched_uids = uid_array(())
+
+    def fetch(srv: IMAPClient, part: Sequence[int]) -> dict:
+        return fetch_from_headers(srv, part, attempts=args.retries, base_delay=args.retry_delay)
+
+    for fetched in iter_fetched(fetch_servers, chunked(all_uids, max(1, args.batch)), fetch):
+        for uid, item in fetched.items():
+            host, full_email = parse_from_header(from_header_bytes(item))
+            if not host and not full_email:
                 continue
 
+            hits = match(host, full_email)
+            for i in hits:
+                per_rule[i] += 1
+            if hits:
+                matched_uids.append(uid)
+
+    # Batches never overlap, but dedupe once here rather than per insert
+    matched_uids = uid_array(sorted(set(matched_uids)))
+    folder_unique = len(matched_uids)
+    if folder_unique == 0:
+        return per_rule, 0, 0
+
+    report = [f"Folder: {folder}"]
+    for i, r in enumerate(rules):
+        if per_rule[i]:
+            report.append(f"  {r:55s}: {per_rule[i]}")
+    report.append(f"  -> Unique matched in folder: {folder_unique}")
+
+    deleted_here = 0
+    if args.delete:
+        batch = args.delete_batch or (UIDPLUS_DELETE_BATCH if uidplus else args.batch)
+        deleted_here = delete_uids(server, matched_uids, batch=batch, uidplus=uidplus)
+        report.append(f"  Deleted: {deleted_here}\n")
+    else:
+        report.append("  (dry-run: nothing deleted)\n")
+    emit(*report)
+    return per_rule, folder_unique, deleted_here
+
+
+def scan_parallel(sessions: List[IMAPClient], folders: List[str],
+                  match: Callable[[str, str], Tuple[int, ...]], rules: List[str],
+                  args: argparse.Namespace, uidplus: bool) -> List[Tuple[List[int], int, int]]:
+    """
+    Every session gets its own worker thread pulling folders off a shared
+    queue; IMAPClient objects are never shared between threads.
+    """
+    todo: "queue.Queue[str]" = queue.Queue()
+    for folder in folders:
+        todo.put(folder)
+
+    def worker(server: IMAPClient) -> List[Tuple[List[int], int, int]]:
+        results = []
+        while True:
             try:
-                all_uids = with_retries(lambda: server.search(["NOT", "DELETED"]),
-                                        attempts=args.retries, base_delay=args.retry_delay)
-            except Exception as e:
-                print(f"[WARN] UID listing failed in '{folder}': {e}")
-                continue
+                folder = todo.get_nowait()
+            except queue.Empty:
+                return results
+            results.append(scan_folder(server, [], folder, match, rules, args, uidplus))
+
+    with ThreadPoolExecutor(max_workers=len(sessions)) as pool:
+        futures = [pool.submit(worker, srv) for srv in sessions]
+    return [res for fut in futures for res in fut.result()]
+
+
+def run_pass(server: IMAPClient, extra_servers: List[IMAPClient], folders: List[str],
+             match: Callable[[str, str], Tuple[int, ...]], rules: List[str],
+             args: argparse.Namespace, uidplus: bool) -> None:
+    grand_per_rule = [0] * len(rules)
+    grand_unique = 0
+    grand_deleted = 0
+
+    workers = min(max(1, args.workers), len(folders), 1 + len(extra_servers))
+    if workers > 1:
+        # Folders are independent: every session scans its own folders
+        sessions = [server] + extra_servers[:workers - 1]
+        results = scan_parallel(sessions, folders, match, rules, args, uidplus)
+    else:
+        prefetch_servers = [] if args.no_prefetch else extra_servers[:1]
+        results = [scan_folder(server, prefetch_servers, folder, match, rules, args, uidplus)
+                   for folder in folders]
+
+    for per_rule, folder_unique, deleted_here in results:
+        grand_per_rule = [a + b for a, b in zip(grand_per_rule, per_rule)]
+        grand_unique += folder_unique
+        grand_deleted += deleted_here
+
+    print("=== SUMMARY ===")
+    print(f"Total unique matched (across processed folders): {grand_unique}")
+    if args.delete:
+        print(f"Total deleted: {grand_deleted}")
+    print("Counts by rule (may overlap across folders):")
+    for i, r in enumerate(rules):
+        print(f"  {r:55s}: {grand_per_rule[i]}")
+
+
+def wait_for_trigger(server: IMAPClient, keepalive: List[IMAPClient], interval: float,
+                     triggered: threading.Event) -> bool:
+    """
+    Holds the session in IDLE until the interval elapses or a pass is
+    requested (SIGUSR1); returns True in the latter case. IDLE is re-issued before the 29-minute server limit.
+    Without the IDLE capability the wait is a sleep loop and the main session
+    is NOOPed like the others. The other sessions (prefetch, workers) get a NOOP every
+    KEEPALIVE_INTERVAL so the server does not log them out between passes.
+    """
+    use_idle = server.has_capability("IDLE")
+    if not use_idle:
+        keepalive = [server] + keepalive
+    server.select_folder("INBOX", readonly=True)
+    deadline = time.monotonic() + interval
+    next_noop = time.monotonic() + KEEPALIVE_INTERVAL
+    while not triggered.is_set() and time.monotonic() < deadline:
+        idle_until = min(deadline, time.monotonic() + IDLE_REFRESH)
+        if use_idle:
+            server.idle()
+        try:
+            while not triggered.is_set() and time.monotonic() < idle_until:
+                # Short waits (socket check or sleep), so a signal is noticed quickly
+                timeout = min(1.0, max(0.0, idle_until - time.monotonic()))
+                if use_idle:
+                    server.idle_check(timeout=timeout)
+                else:
+                    time.sleep(timeout)
+                if time.monotonic() >= next_noop:
+                    for srv in keepalive:
+                        srv.noop()
+                    next_noop = time.monotonic() + KEEPALIVE_INTERVAL
+        finally:
+            if use_idle:
+                server.idle_done()
+    requested = triggered.is_set()
+    triggered.clear()
+    return requested
 
-            per_rule = Counter()
-            matched_uids: Set[int] = set()
-
-            for part in chunked(all_uids, max(1, args.batch)):
-                fetched = with_retries(lambda: server.fetch(part, ["ENVELOPE"]),
-                                      attempts=args.retries, base_delay=args.retry_delay)
-
-                need_header: List[int] = []
-
-                for uid, item in fetched.items():
-                    env = item.get(b"ENVELOPE") or item.get("ENVELOPE")
-                    if env is None:
-                        need_header.append(uid)
-                        continue
-
-                    _mb, host, full_email = envelope_from_parts(env)
-                    if not host and not full_email:
-                        need_header.append(uid)
-                        continue
-
-                    hit = False
-                    for r in rules:
-                        if match_rule(r, host=host, full_email=full_email):
-                            per_rule[r] += 1
-                            hit = True
-                    if hit:
-                        matched_uids.add(uid)
-
-                if need_header:
-                    hdr = with_retries(
-                        lambda: server.fetch(need_header, ["BODY.PEEK[HEADER.FIELDS (FROM)]"]),
-                        attempts=args.retries, base_delay=args.retry_delay
-                    )
-                    for uid, item in hdr.items():
-                        raw = (
-                            item.get(b"BODY[HEADER.FIELDS (FROM)]")
-                            or item.get(b"BODY.PEEK[HEADER.FIELDS (FROM)]")
-                            or b""
-                        )
-                        host, full_email = parse_from_header(raw)
-                        if not host and not full_email:
-                            continue
-
-                        hit = False
-                        for r in rules:
-                            if match_rule(r, host=host, full_email=full_email):
-                                per_rule[r] += 1
-                                hit = True
-                        if hit:
-                            matched_uids.add(uid)
-
-            folder_unique = len(matched_uids)
-            if folder_unique == 0:
-                continue
 
-            print(f"Folder: {folder}")
-            for r in rules:
-                if per_rule[r]:
-                    print(f"  {r:55s}: {per_rule[r]}")
-            print(f"  -> Unique matched in folder: {folder_unique}")
+def main() -> None:
+    args = parse_args()
 
-            grand_per_rule.update(per_rule)
-            grand_unique += folder_unique
+    user = args.user or os.getenv("RAMBLER_USER")
+    password = args.password or os.getenv("RAMBLER_PASS")
+    if not user or not password:
+        raise SystemExit("Set credentials via --user/--password or env RAMBLER_USER / RAMBLER_PASS")
 
-            if args.delete:
-                deleted_here = delete_uids(server, sorted(matched_uids), batch=args.batch, uidplus=uidplus)
-                grand_deleted += deleted_here
-                print(f"  Deleted: {deleted_here}\n")
-            else:
-                print("  (dry-run: nothing deleted)\n")
-
-        print("=== SUMMARY ===")
-        print(f"Total unique matched (across processed folders): {grand_unique}")
-        if args.delete:
-            print(f"Total deleted: {grand_deleted}")
-        print("Counts by rule (may overlap across folders):")
-        for r in rules:
-            print(f"  {r:55s}: {grand_per_rule[r]}")
+    compiled_rules = normalize_rules((args.rules or "").split(","))
+    rules = [r for _kind, r in compiled_rules]
+    if not rules:
+        raise SystemExit("No rules provided")
+
+    skip = {f.strip() for f in (args.skip_folders or "").split(",") if f.strip()}
+
+    match = make_matcher(compiled_rules)
+
+    triggered = threading.Event()
+    if args.daemon and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda _signum, _frame: triggered.set())
+
+    while True:
+        try:
+            with open_sessions(user, password) as (server, extra):
+                selectable = list_selectable_mailboxes(server)
+                if args.list_folders:
+                    print("Selectable folders:")
+                    for f in selectable:
+                        print(" -", f)
+                    return
+
+                folders = resolve_folders(selectable, args.folders, skip)
+                uidplus = supports_uidplus(server)
+                extra_servers = open_extra_sessions(extra, user, password,
+                                                    extra_sessions_needed(args, len(folders)))
+
+                print(f"Server: {IMAP_HOST}:{IMAP_PORT} SSL | Folders: {len(folders)} | Mode: {'DELETE' if args.delete else 'DRY-RUN'}")
+                print("Rules:")
+                for kind, r in compiled_rules:
+                    print(f"  {r} ({kind})")
+                print()
+                if args.server_search and search_needles(rules) is None:
+                    print("[WARN] --server-search: some rules have no literal part, scanning all messages\n")
+
+                while True:
+                    run_pass(server, extra_servers, folders, match, rules, args, uidplus)
+                    if not args.daemon:
+                        return
+                    print(f"\n[DAEMON] Waiting up to {args.interval:.0f}s or SIGUSR1 for the next pass\n")
+                    requested = wait_for_trigger(server, extra_servers, args.interval, triggered)
+                    # Scheduled passes reuse the cached LIST; SIGUSR1 also picks up new folders
+                    selectable = list_selectable_mailboxes(server, refresh=requested)
+                    folders = resolve_folders(selectable, args.folders, skip)
+        except KeyboardInterrupt:
+            if args.daemon:
+                return
+            raise
+        except Exception as e:
+            if not args.daemon or not is_connection_error(e):
+                raise
+            print(f"[WARN] Session lost, reconnecting in {args.retry_delay:.0f}s: {e}")
+            time.sleep(args.retry_delay)
 
 
 if __name__ == "__main__":